@@ -1,47 +1,116 @@
 import scipy
+import cv2
 from glob import glob
 import numpy as np
 import matplotlib.pyplot as plt
 import os
-from scipy.ndimage import zoom
+import queue
+import threading
 class DataLoader():
-    def __init__(self, dataset_name, img_res=(128, 128)):
+    def __init__(self, dataset_name, img_res=(128, 128), packed_path=None):
         self.dataset_name = dataset_name
         self.img_res = img_res
+        # HR images pre-decoded by prepack.py, sampled instead of the image files when present
+        self.packed = None
+        if packed_path is not None and os.path.exists(packed_path):
+            self.packed = np.load(packed_path, mmap_mode='r')
+            assert self.packed.shape[1:] == tuple(img_res) + (3,), \
+                '%s holds %s images, expected %s' % (packed_path, self.packed.shape[1:], tuple(img_res) + (3,))
 
     def load_data(self, batch_size=1, is_testing=False, is_pred=False):
         data_type = "train" if not is_testing else "test"
+        if self.packed is not None and not is_pred:
+            return self.load_packed_data(batch_size, is_testing)
         if is_pred:
-            batch_images = ['test_images/Set5' + x for x in os.listdir('test_images/Set5')]
+            batch_images = [os.path.join('test_images/Set5', x) for x in os.listdir('test_images/Set5')]
         else:
             path = glob('%s/*' % (self.dataset_name))
             batch_images = np.random.choice(path, size=batch_size)
 
         imgs_hr = []
-        imgs_lr = []
         for img_path in batch_images:
-            img = self.imread(img_path)
-
-            h, w = self.img_res
-            low_h, low_w = int(h / 4), int(w / 4)
-
-            img_hr = scipy.misc.imresize(img, self.img_res)
-            # img_lr = scipy.misc.imresize(img, (low_h, low_w))
-            img_lr = zoom(img, (1 / 4, 1 / 4, 1), order=3)  # bicubic下采样
+            img_hr = self.load_hr(img_path)
 
             # If training => do random flip
             if not is_testing and np.random.random() < 0.5:
                 img_hr = np.fliplr(img_hr)
-                img_lr = np.fliplr(img_lr)
 
             imgs_hr.append(img_hr)
-            imgs_lr.append(img_lr)
 
-        imgs_hr = np.array(imgs_hr) / 127.5 - 1.
-        imgs_lr = np.array(imgs_lr) / 127.5 - 1.
+        # bicubic下采样, for the whole batch at once
+        imgs_hr = np.array(imgs_hr)
+        imgs_lr = self.downsample(imgs_hr)
+
+        imgs_hr = imgs_hr / 127.5 - 1.
+        imgs_lr = imgs_lr / 127.5 - 1.
+
+        return imgs_hr, imgs_lr
+
+    def load_packed_data(self, batch_size=1, is_testing=False):
+        """Same as load_data, but slices the HR images out of the memory-mapped pack"""
+        # Sorted indices keep the reads from the pack in file order
+        idx = np.sort(np.random.randint(len(self.packed), size=batch_size))
+        imgs_hr = self.packed[idx]
+
+        # If training => do random flip
+        if not is_testing:
+            flipped = np.random.random(batch_size) < 0.5
+            imgs_hr[flipped] = imgs_hr[flipped, :, ::-1]
+
+        imgs_lr = self.downsample(imgs_hr)
+
+        imgs_hr = imgs_hr.astype(np.float32) / 127.5 - 1.
+        imgs_lr = imgs_lr.astype(np.float32) / 127.5 - 1.
 
         return imgs_hr, imgs_lr
 
+    @staticmethod
+    def downsample(imgs_hr):
+        """Bicubic 4x downsampling of a batch of uint8 images"""
+        b, h, w, c = imgs_hr.shape
+        # cv2 resizes up to 512 channels at once, so the batch is stacked along the channels
+        chunk = 512 // c
+        imgs_lr = []
+        for i in range(0, b, chunk):
+            imgs = imgs_hr[i:i + chunk]
+            n = len(imgs)
+            imgs = np.ascontiguousarray(imgs.transpose(1, 2, 0, 3)).reshape(h, w, n * c)
+            imgs = cv2.resize(imgs, (w // 4, h // 4), interpolation=cv2.INTER_CUBIC)
+            imgs_lr.append(imgs.reshape(h // 4, w // 4, n, c).transpose(2, 0, 1, 3))
+        return np.concatenate(imgs_lr, axis=0)
+
+    def prefetch_data(self, batch_size=1, queue_size=2):
+        """Yields training batches while a background thread loads the next ones"""
+        batches = queue.Queue(maxsize=queue_size)
+        stop = threading.Event()
+
+        def producer():
+            while not stop.is_set():
+                try:
+                    batch = self.load_data(batch_size)
+                except Exception as e:
+                    batch = e
+                while not stop.is_set():
+                    try:
+                        batches.put(batch, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+
+        threading.Thread(target=producer, daemon=True).start()
+        try:
+            while True:
+                batch = batches.get()
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            stop.set()
+
+
+    def load_hr(self, path):
+        """Reads an image as uint8 HR image of img_res, also used by prepack.py to build the pack"""
+        return scipy.misc.imresize(self.imread(path), self.img_res)
 
     def imread(self, path):
         return scipy.misc.imread(path, mode='RGB').astype(np.float)
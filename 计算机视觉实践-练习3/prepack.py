@@ -0,0 +1,30 @@
+import sys
+import numpy as np
+from glob import glob
+from data_loader import DataLoader
+
+
+def prepack(dataset_name, packed_path, img_res=(256, 256)):
+    """
+    Decodes and resizes every image of the dataset once and stores them in a single uint8
+    .npy file of shape (N, h, w, 3), which DataLoader memory-maps instead of reading the images.
+    The images go through the same DataLoader.load_hr() as when they are read from the files
+    """
+    data_loader = DataLoader(dataset_name=dataset_name, img_res=img_res)
+    paths = sorted(glob('%s/*' % (dataset_name)))
+    h, w = img_res
+    imgs_hr = np.lib.format.open_memmap(packed_path, mode='w+', dtype=np.uint8,
+                                        shape=(len(paths), h, w, 3))
+    for i, path in enumerate(paths):
+        imgs_hr[i] = data_loader.load_hr(path)
+        if i % 1000 == 0:
+            print('%d / %d' % (i, len(paths)))
+    imgs_hr.flush()
+
+
+if __name__ == '__main__':
+    # Usage: python prepack.py <dataset_dir> [packed_path]
+    # SRGAN looks for the pack at <dataset_dir>.npy, the default packed_path
+    dataset_name = sys.argv[1].rstrip('/\\')
+    packed_path = sys.argv[2] if len(sys.argv) > 2 else dataset_name + '.npy'
+    prepack(dataset_name, packed_path)
@@ -3,21 +3,140 @@
 from __future__ import print_function, division
 from keras.layers import *
 from keras.layers.advanced_activations import LeakyReLU
-from keras.layers.convolutional import UpSampling2D, Conv2D
+from keras.layers.convolutional import Conv2D
+from keras.layers import Layer
 from keras.applications import VGG19
 from keras.models import Model
 from keras.optimizers import Adam
+from keras import backend as K
+import tensorflow as tf
+from tensorflow.core.protobuf import rewriter_config_pb2
 import datetime
 import matplotlib.pyplot as plt
+from PIL import Image
 from data_loader import DataLoader
 import numpy as np
 import os
-from skimage.metrics import peak_signal_noise_ratio as psnr
 from skimage.metrics import structural_similarity as ssim
+try:
+    # Optional, for data-parallel training on several GPUs with horovodrun
+    import horovod.keras as hvd
+except ImportError:
+    hvd = None
+
+
+class SubPixelConv2D(Layer):
+    """
+    Computes UpSampling2D(size=2) followed by a 3x3 'same' Conv2D directly on the low
+    resolution input. Each of the 4 output phases only sees a 2x2 window of the input,
+    so the upsampled tensor is never materialized and the conv needs 4/9 of the taps.
+    The weights have the same shapes as the Conv2D they replace
+    """
+
+    def __init__(self, filters, **kwargs):
+        super(SubPixelConv2D, self).__init__(**kwargs)
+        self.filters = filters
+
+    def build(self, input_shape):
+        self.kernel = self.add_weight(name='kernel',
+                                      shape=(3, 3, int(input_shape[-1]), self.filters),
+                                      initializer='glorot_uniform')
+        self.bias = self.add_weight(name='bias', shape=(self.filters,), initializer='zeros')
+        super(SubPixelConv2D, self).build(input_shape)
+
+    def call(self, inputs):
+        def phase_taps(k, phase, axis):
+            # Taps of the 3x3 kernel that land on the same input pixel are summed
+            k0, k1, k2 = tf.unstack(k, axis=axis)
+            taps = [k0, k1 + k2] if phase == 0 else [k0 + k1, k2]
+            return tf.stack(taps, axis=axis)
+
+        # 2x2 kernels of the 4 phases, ordered as expected by depth_to_space
+        kernel = tf.concat([phase_taps(phase_taps(self.kernel, a, 0), b, 1)
+                            for a in (0, 1) for b in (0, 1)], axis=-1)
+        x = tf.pad(inputs, [[0, 0], [1, 1], [1, 1], [0, 0]])
+        x = tf.nn.conv2d(x, kernel, strides=[1, 1, 1, 1], padding='VALID')
+
+        # Phase (a, b) is the conv output shifted by (a, b)
+        h, w = tf.shape(inputs)[1], tf.shape(inputs)[2]
+        phases = [x[:, a:a + h, b:b + w, (2 * a + b) * self.filters:(2 * a + b + 1) * self.filters]
+                  for a in (0, 1) for b in (0, 1)]
+        x = tf.nn.depth_to_space(tf.concat(phases, axis=-1), 2)
+        return tf.nn.bias_add(x, self.bias)
+
+    def compute_output_shape(self, input_shape):
+        h, w = [None if dim is None else dim * 2 for dim in input_shape[1:3]]
+        return input_shape[0], h, w, self.filters
+
+    def get_config(self):
+        config = super(SubPixelConv2D, self).get_config()
+        config['filters'] = self.filters
+        return config
+
+
+class FusedResidualBlock(Layer):
+    """
+    Inference-only version of the generator's residual block (Conv-ReLU-BN-Conv-BN-Add) as a
+    single layer: the first BN is a per-channel scale and offset and the second one is folded
+    into its conv. Weights are set by SRGAN.fold_batchnorm()
+    """
+
+    def __init__(self, filters, **kwargs):
+        super(FusedResidualBlock, self).__init__(**kwargs)
+        self.filters = filters
+
+    def build(self, input_shape):
+        channels = int(input_shape[-1])
+        self.kernel1 = self.add_weight(name='kernel1', shape=(3, 3, channels, self.filters),
+                                       initializer='glorot_uniform', trainable=False)
+        self.bias1 = self.add_weight(name='bias1', shape=(self.filters,),
+                                     initializer='zeros', trainable=False)
+        self.scale = self.add_weight(name='scale', shape=(self.filters,),
+                                     initializer='ones', trainable=False)
+        self.offset = self.add_weight(name='offset', shape=(self.filters,),
+                                      initializer='zeros', trainable=False)
+        self.kernel2 = self.add_weight(name='kernel2', shape=(3, 3, self.filters, channels),
+                                       initializer='glorot_uniform', trainable=False)
+        self.bias2 = self.add_weight(name='bias2', shape=(channels,),
+                                     initializer='zeros', trainable=False)
+        super(FusedResidualBlock, self).build(input_shape)
+
+    def call(self, inputs):
+        d = tf.nn.conv2d(inputs, self.kernel1, strides=[1, 1, 1, 1], padding='SAME')
+        d = tf.nn.relu(tf.nn.bias_add(d, self.bias1)) * self.scale + self.offset
+        d = tf.nn.conv2d(d, self.kernel2, strides=[1, 1, 1, 1], padding='SAME')
+        return inputs + tf.nn.bias_add(d, self.bias2)
+
+    def compute_output_shape(self, input_shape):
+        return input_shape
+
+    def get_config(self):
+        config = super(FusedResidualBlock, self).get_config()
+        config['filters'] = self.filters
+        return config
 
 
 class SRGAN():
     def __init__(self):
+        # Let XLA compile the Keras graphs, fusing the conv + activation + BN chains, and
+        # let the graph rewrite run convs and matmuls in float16 (sensitive ops stay float32)
+        config = tf.ConfigProto()
+        config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+        config.graph_options.rewrite_options.auto_mixed_precision = rewriter_config_pb2.RewriterConfig.ON
+        # Static loss scale keeping small float16 gradients (e.g. of the 1e-3 weighted adversarial
+        # loss) from flushing to zero. Adam's update is invariant to a constant loss scale, so the
+        # losses are simply compiled with it and the reported loss values are scaled by it too
+        self.loss_scale = 512.
+        # With horovod every process trains on its own GPU and only rank 0 logs and saves
+        self.rank = 0
+        if hvd is not None:
+            hvd.init()
+            self.rank = hvd.rank()
+            config.gpu_options.visible_device_list = str(hvd.local_rank())
+        K.set_session(tf.Session(config=config))
+        # The models, the tf.nn based layers and the data loader all work on NHWC images
+        K.set_image_data_format('channels_last')
+
         # Input shape
         self.channels = 3
         self.lr_height = 64  # Low resolution height
@@ -31,20 +150,21 @@ class SRGAN():
         self.n_residual_blocks = 16
 
         optimizer = Adam(0.0002, 0.5)
+        if hvd is not None:
+            # Averages the gradients of all processes before each update
+            optimizer = hvd.DistributedOptimizer(optimizer)
 
         # We use a pre-trained VGG19 model to extract image features from the high resolution
         # and the generated high resolution images and minimize the mse between them
         self.vgg = self.build_vgg()
         self.vgg.trainable = False
         self.vgg.summary()
-        self.vgg.compile(loss='mse',
-                         optimizer=optimizer,
-                         metrics=['accuracy'])
 
         # Configure data loader
         self.dataset_name = 'D:/github_repos/Keras-GAN-master/datasets/img_align_celeba'
         self.data_loader = DataLoader(dataset_name=self.dataset_name,
-                                      img_res=(self.hr_height, self.hr_width))
+                                      img_res=(self.hr_height, self.hr_width),
+                                      packed_path=self.dataset_name + '.npy')
 
         # Calculate output shape of D (PatchGAN)
         patch = int(self.hr_height / 2 ** 4)
@@ -56,13 +176,22 @@ class SRGAN():
 
         # Build and compile the discriminator
         self.discriminator = self.build_discriminator()
+        # Adversarial ground truths are built in the graph instead of being fed every step:
+        # the discriminator is trained on [real; fake] batches, so the first half is valid
+        d_out = self.discriminator.output
+        half = K.shape(d_out)[0] // 2
+        d_labels = K.concatenate([K.ones_like(d_out[:half]), K.zeros_like(d_out[half:])], axis=0)
         self.discriminator.compile(loss='mse',
+                                   loss_weights=[self.loss_scale],
                                    optimizer=optimizer,
-                                   metrics=['accuracy'])
+                                   metrics=['accuracy'],
+                                   target_tensors=[d_labels])
         self.discriminator.summary()
 
         # Build the generator
         self.generator = self.build_generator()
+        # Inference copy of the generator with BN folded into the convs, built on demand
+        self.folded_generator = None
 
         # High res. and low res. images
         img_hr = Input(shape=self.hr_shape)
@@ -82,9 +211,16 @@ class SRGAN():
 
         self.combined = Model([img_lr, img_hr], [validity, fake_features])
         self.combined.summary()
+        # The generators want the discriminators to label the generated images as real (valid),
+        # only the VGG features of the HR images are fed
         self.combined.compile(loss=['binary_crossentropy', 'mse'],
-                              loss_weights=[1e-3, 1],
-                              optimizer=optimizer)
+                              loss_weights=[1e-3 * self.loss_scale, self.loss_scale],
+                              optimizer=optimizer,
+                              target_tensors=[K.ones_like(validity), None])
+
+        if hvd is not None:
+            # Start every process from the same weights
+            hvd.broadcast_global_variables(0)
 
     def build_vgg(self):
         """
@@ -105,10 +241,17 @@ class SRGAN():
 
         return Model(img, img_features)
 
-    def build_generator(self):
+    def build_generator(self, fold_bn=False):
+        """
+        Builds the generator. With fold_bn=True an inference copy is built instead: the
+        BatchNormalization layers that directly follow a Conv2D are left out and the residual
+        blocks are FusedResidualBlock layers, their weights are set by fold_batchnorm()
+        """
 
         def residual_block(layer_input, filters):
             """Residual block described in paper"""
+            if fold_bn:
+                return FusedResidualBlock(filters)(layer_input)
             d = Conv2D(filters, kernel_size=3, strides=1, padding='same')(layer_input)
             d = Activation('relu')(d)
             d = BatchNormalization(momentum=0.8)(d)
@@ -119,8 +262,7 @@ class SRGAN():
 
         def deconv2d(layer_input):
             """Layers used during upsampling"""
-            u = UpSampling2D(size=2)(layer_input)
-            u = Conv2D(256, kernel_size=3, strides=1, padding='same')(u)
+            u = SubPixelConv2D(256)(layer_input)
             u = Activation('relu')(u)
             return u
 
@@ -138,7 +280,8 @@ class SRGAN():
 
         # Post-residual block
         c2 = Conv2D(64, kernel_size=3, strides=1, padding='same')(r)
-        c2 = BatchNormalization(momentum=0.8)(c2)
+        if not fold_bn:
+            c2 = BatchNormalization(momentum=0.8)(c2)
         c2 = Add()([c2, c1])
 
         # Upsampling
@@ -150,6 +293,42 @@ class SRGAN():
 
         return Model(img_lr, gen_hr)
 
+    def fold_batchnorm(self):
+        """
+        Copies the generator weights into the inference generator. At inference a BN is the
+        per-channel affine x * scale + offset, with scale = gamma / sqrt(var + eps) and
+        offset = beta - mean * scale, so every Conv2D->BatchNormalization pair is folded into
+        a single Conv2D: w' = w * scale, b' = b * scale + offset
+        """
+        if self.folded_generator is None:
+            self.folded_generator = self.build_generator(fold_bn=True)
+
+        def bn_affine(bn):
+            gamma, beta, mean, var = bn.get_weights()
+            scale = gamma / np.sqrt(var + bn.epsilon)
+            return scale, beta - mean * scale
+
+        src = [layer for layer in self.generator.layers if layer.weights]
+        for layer in self.folded_generator.layers:
+            if not layer.weights:
+                continue
+            if isinstance(layer, FusedResidualBlock):
+                # Conv, BN, Conv, BN of one residual block
+                kernel1, bias1 = src.pop(0).get_weights()
+                scale1, offset1 = bn_affine(src.pop(0))
+                kernel2, bias2 = src.pop(0).get_weights()
+                scale2, offset2 = bn_affine(src.pop(0))
+                weights = [kernel1, bias1, scale1, offset1, kernel2 * scale2, bias2 * scale2 + offset2]
+            else:
+                weights = src.pop(0).get_weights()
+                # A BN directly after this conv was left out of the inference generator
+                if isinstance(layer, Conv2D) and src and isinstance(src[0], BatchNormalization):
+                    scale, offset = bn_affine(src.pop(0))
+                    weights = [weights[0] * scale, weights[1] * scale + offset]
+            layer.set_weights(weights)
+
+        return self.folded_generator
+
     def build_discriminator(self):
 
         def d_block(layer_input, filters, strides=1, bn=True):
@@ -181,65 +360,82 @@ class SRGAN():
     def train(self, epochs, batch_size=1, sample_interval=5):
         start_time = datetime.datetime.now()
 
-        for epoch in range(epochs):
-            if epoch > 30:
-                sample_interval = 10
-            if epoch > 100:
-                sample_interval = 50
-
-            # ----------------------
-            #  Train Discriminator
-            # ----------------------
-
-            # Sample images and their conditioning counterparts
-            imgs_hr, imgs_lr = self.data_loader.load_data(batch_size)
-
-            # From low res. image generate high res. version
-            fake_hr = self.generator.predict(imgs_lr)
-
-            valid = np.ones((batch_size,) + self.disc_patch)
-            fake = np.zeros((batch_size,) + self.disc_patch)
-
-            # Train the discriminators (original images = real / generated = Fake)
-            d_loss_real = self.discriminator.train_on_batch(imgs_hr, valid)
-            d_loss_fake = self.discriminator.train_on_batch(fake_hr, fake)
-            d_loss = 0.5 * np.add(d_loss_real, d_loss_fake)
-
-            # ------------------
-            #  Train Generator
-            # ------------------
-
-            # Sample images and their conditioning counterparts
-            imgs_hr, imgs_lr = self.data_loader.load_data(batch_size)
-
-            # The generators want the discriminators to label the generated images as real
-            valid = np.ones((batch_size,) + self.disc_patch)
-
-            # Extract ground truth image features using pre-trained VGG19 model
-            image_features = self.vgg.predict(imgs_hr)
-
-            # Train the generators
-            g_loss = self.combined.train_on_batch([imgs_lr, imgs_hr], [valid, image_features])
-
-            elapsed_time = datetime.datetime.now() - start_time
-            # Plot the progress
-            print("%d time: %s" % (epoch, elapsed_time))
-
-            # If at save interval => save generated image samples
-            if epoch % sample_interval == 0:
-                self.sample_images_new(epoch)
-            if epoch % 500 == 0 and epoch > 1:
-                self.generator.save_weights('./saved_model/' + str(epoch) + '.h5')
+        # batch_size is the global batch, split evenly over the horovod processes
+        if hvd is not None:
+            assert batch_size % hvd.size() == 0, \
+                'batch_size %d is not divisible by the %d horovod processes' % (batch_size, hvd.size())
+            batch_size //= hvd.size()
+
+        # Training batches are loaded in the background while the GPU trains
+        batches = self.data_loader.prefetch_data(batch_size)
+
+        try:
+            for epoch in range(epochs):
+                if epoch > 30:
+                    sample_interval = 10
+                if epoch > 100:
+                    sample_interval = 50
+
+                # ----------------------
+                #  Train Discriminator
+                # ----------------------
+
+                # Sample images and their conditioning counterparts, shared by both steps
+                imgs_hr, imgs_lr = next(batches)
+
+                # From low res. image generate high res. version
+                fake_hr = self.generator.predict_on_batch(imgs_lr)
+
+                # Train the discriminators (original images = real / generated = Fake)
+                # Real and fake images go through in one batch, so the returned loss
+                # is already the mean of the real and fake losses
+                d_imgs = np.concatenate([imgs_hr, fake_hr], axis=0)
+                d_loss = self.discriminator.train_on_batch(d_imgs, None)
+
+                # ------------------
+                #  Train Generator
+                # ------------------
+
+                # Extract ground truth image features using pre-trained VGG19 model
+                image_features = self.vgg.predict_on_batch(imgs_hr)
+
+                # Train the generators
+                g_loss = self.combined.train_on_batch([imgs_lr, imgs_hr], [image_features])
+
+                if self.rank != 0:
+                    continue
+
+                elapsed_time = datetime.datetime.now() - start_time
+                # Plot the progress
+                print("%d time: %s" % (epoch, elapsed_time))
+
+                # If at save interval => save generated image samples
+                if epoch % sample_interval == 0:
+                    self.sample_images_new(epoch)
+                if epoch % 500 == 0 and epoch > 1:
+                    self.generator.save_weights('./saved_model/' + str(epoch) + '.h5')
+        finally:
+            # Stops the prefetch thread also when training is interrupted
+            batches.close()
+
+    @staticmethod
+    def to_uint8(imgs):
+        """Converts float images from [-1, 1] to uint8 (0-255), rescaling imgs in place"""
+        imgs += 1
+        imgs *= 127.5
+        np.clip(imgs, 0, 255, out=imgs)
+        return imgs.astype(np.uint8)
 
     def test_images(self, batch_size=1):
         imgs_hr, imgs_lr = self.data_loader.load_data(batch_size, is_pred=True)
         os.makedirs('saved_model/', exist_ok=True)
         self.generator.load_weights('./saved_model/' + str(2000) + '.h5')
-        fake_hr = self.generator.predict(imgs_lr)
+        fake_hr = self.fold_batchnorm().predict(imgs_lr)
         r, c = imgs_hr.shape[0], 2
-        imgs_lr = 0.5 * imgs_lr + 0.5
-        fake_hr = 0.5 * fake_hr + 0.5
-        imgs_hr = 0.5 * imgs_hr + 0.5
+        # Rescale images from [-1, 1] to uint8 (0-255) in a single pass
+        imgs_lr = self.to_uint8(imgs_lr)
+        fake_hr = self.to_uint8(fake_hr)
+        imgs_hr = self.to_uint8(imgs_hr)
 
         # Save generated images and the high resolution originals
         titles = ['Low resolution input', 'Generated Super resolution']
@@ -254,25 +450,17 @@ class SRGAN():
 
         # Save low resolution and generated high resolution images to files
         for i, (lr_img, hr_img) in enumerate(zip(imgs_lr, fake_hr)):
-            plt.imsave(f"./res/bicubic_downsampling_{i+1}.png", lr_img)
-            plt.imsave(f"./res/gen_high_resolution_{i+1}.png", hr_img)
+            Image.fromarray(lr_img).save(f"./res/bicubic_downsampling_{i+1}.png")
+            Image.fromarray(hr_img).save(f"./res/gen_high_resolution_{i+1}.png")
 
         # Calculate PSNR and SSIM
-        psnr_values = []
-        ssim_values = []
-        for img_real, img_generated in zip(imgs_hr, fake_hr):
-            # Convert images to uint8 format (0-255)
-            img_real = ((img_real + 1) * 127.5).astype(np.uint8)
-            img_generated = ((img_generated + 1) * 127.5).astype(np.uint8)
-
-            # Calculate PSNR
-            psnr_value = psnr(img_real, img_generated)
-            psnr_values.append(psnr_value)
-
-            # Calculate SSIM
-            ssim_value = ssim(img_real, img_generated, multichannel=True)
-            ssim_values.append(ssim_value)
-        print(psnr_values)
+        # PSNR of the whole batch at once from the per-image mse
+        mse = np.mean((imgs_hr.astype(np.float32) - fake_hr.astype(np.float32)) ** 2, axis=(1, 2, 3))
+        psnr_values = 10 * np.log10(255.0 ** 2 / mse)
+
+        ssim_values = [ssim(img_real, img_generated, multichannel=True, data_range=255)
+                       for img_real, img_generated in zip(imgs_hr, fake_hr)]
+        print(psnr_values.tolist())
         print(ssim_values)
         avg_psnr = np.mean(psnr_values)
         avg_ssim = np.mean(ssim_values)
@@ -287,23 +475,18 @@ class SRGAN():
     def sample_images_new(self, epoch):
         os.makedirs('images/', exist_ok=True)
         imgs_hr, imgs_lr = self.data_loader.load_data(batch_size=1, is_testing=True, is_pred=True)
-        fake_hr = self.generator.predict(imgs_lr)
-
-        imgs_lr = 0.5 * imgs_lr + 0.5
-        fake_hr = 0.5 * fake_hr + 0.5
-        imgs_hr = 0.5 * imgs_hr + 0.5
-        r, c = imgs_hr.shape[0], 3
-        titles = ['Generated  epoch: ' + str(epoch), 'Original', 'Low']
-        fig, axs = plt.subplots(r, c)
-
-        for row in range(r):
-            for col, image in enumerate([fake_hr, imgs_hr, imgs_lr]):
-                axs[row, col].imshow(image[row])
-                axs[row, col].set_title(titles[col])
-                axs[row, col].axis('off')
-
-        fig.savefig("images/%d.png" % (epoch))
-        plt.close()
+        fake_hr = self.fold_batchnorm().predict(imgs_lr)
+
+        imgs_lr = self.to_uint8(imgs_lr)
+        fake_hr = self.to_uint8(fake_hr)
+        imgs_hr = self.to_uint8(imgs_hr)
+        # Nearest neighbour upscale of the low resolution input to the generated size
+        imgs_lr = imgs_lr.repeat(4, axis=1).repeat(4, axis=2)
+
+        # One row per image: generated, original, low
+        tile = np.concatenate([fake_hr, imgs_hr, imgs_lr], axis=2)
+        tile = tile.reshape((-1,) + tile.shape[2:])
+        Image.fromarray(tile).save("images/%d.png" % (epoch))
 
 
 if __name__ == '__main__':